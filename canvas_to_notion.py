@@ -1,8 +1,15 @@
+import html
 import os
-import json
 import requests
 import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==============================
 # CONFIG
@@ -24,34 +31,155 @@ INCLUDE_ASSIGNMENTS_WITHOUT_DUE_DATE = os.environ.get(
     "INCLUDE_ASSIGNMENTS_WITHOUT_DUE_DATE", "false"
 ).lower() == "true"
 
+NOTION_API = "https://api.notion.com/v1"
 NOTION_VERSION = "2022-06-28"
 
+# Concurrency (Canvas requests are independent per course;
+# Notion allows ~3 requests/second per integration)
+CANVAS_MAX_WORKERS = 8
+NOTION_MAX_WORKERS = 3
+NOTION_REQUESTS_PER_SECOND = 3
+
+# (connect, read) timeout in seconds for every HTTP call
+REQUEST_TIMEOUT = (5, 30)
+
+# Auth headers, built once and attached to the per-host sessions below
+CANVAS_HEADERS = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
+NOTION_HEADERS = {
+    "Authorization": f"Bearer {NOTION_API_KEY}",
+    "Notion-Version": NOTION_VERSION,
+}
+
 
 # ==============================
 # HELPERS
 # ==============================
-def get_headers():
-    return {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json",
-    }
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Statuses that mean the request was rejected before it was acted on
+NOT_PROCESSED_STATUSES = [429, 503]
+
+
+def make_session(headers, pool_size, status_forcelist=RETRY_STATUSES, read=None):
+    """Keep-alive session with a connection pool and retry on 429/5xx."""
+    retry = Retry(
+        total=5,
+        read=read,
+        backoff_factor=1,
+        status_forcelist=status_forcelist,
+        # Notion reads (database query) and writes are POST/PATCH
+        allowed_methods=frozenset(["GET", "POST", "PATCH"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)  # self-hosted Canvas without TLS
+    session.headers.update(headers)
+    return session
 
 
-def clean_description(html):
-    """Strip HTML, remove &nbsp; and limit size."""
-    if not html:
-        return ""
-    text = re.sub(r"<[^>]+>", "", html)          # remove HTML tags
-    text = text.replace("&nbsp;", " ")           # fix your reported &nbsp issue
-    return text.strip()[:500]
+CANVAS_SESSION = make_session(CANVAS_HEADERS, CANVAS_MAX_WORKERS)
+NOTION_SESSION = make_session(NOTION_HEADERS, NOTION_MAX_WORKERS)
+# Creates (POST /pages, POST /databases) may already have happened after a
+# read timeout or 500/502/504, so only retry them when Notion refused them
+NOTION_CREATE_SESSION = make_session(
+    NOTION_HEADERS, NOTION_MAX_WORKERS, NOT_PROCESSED_STATUSES, read=0
+)
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+NOTION_LIMITER = RateLimiter(NOTION_REQUESTS_PER_SECOND)
+
+
+def notion_request(method, path, body=None, session=NOTION_SESSION):
+    """Rate-limited Notion API call; returns the decoded JSON response."""
+    NOTION_LIMITER.wait()
+    r = session.request(
+        method, f"{NOTION_API}{path}", json=body, timeout=REQUEST_TIMEOUT
+    )
+    r.raise_for_status()
+    return r.json()
+
+
+# Group 1 is set for block-level tags, which separate words; inline tags
+# are dropped outright so "H<sub>2</sub>O" stays "H2O". Tag bodies exclude
+# "<" so a run of unclosed "<" is scanned in linear time
+BLOCK_TAGS = "p|br|div|li|h[1-6]|tr|td|th|table|ul|ol|hr|blockquote|pre|section"
+HTML_TAG_RE = re.compile(rf"<(?=[^>])(/?(?:{BLOCK_TAGS})\b)?[^<>]*>", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+
+# Notion rejects title / rich_text content longer than this
+NOTION_TEXT_LIMIT = 2000
+
 
+def clip_text(text):
+    if len(text) <= NOTION_TEXT_LIMIT:
+        return text
+    return text[: NOTION_TEXT_LIMIT - 1] + "…"
 
+
+DESCRIPTION_LIMIT = 500
+# Only this much raw HTML is cleaned first; long rich descriptions rarely
+# need more to yield DESCRIPTION_LIMIT characters of text
+DESCRIPTION_SCAN = 8192
+
+
+def tag_replacement(match):
+    return " " if match.group(1) else ""
+
+
+def html_to_text(raw):
+    text = HTML_TAG_RE.sub(tag_replacement, raw)  # remove HTML tags
+    text = html.unescape(text)                   # &nbsp;, &amp;, ...
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+def clean_description(raw):
+    """Strip HTML, decode entities, collapse whitespace and limit size."""
+    if not raw:
+        return ""
+    if len(raw) > DESCRIPTION_SCAN:
+        # Cut just after a block-level tag: it becomes a space, so no tag,
+        # word or entity is split and the result is an exact prefix of the
+        # full cleaned text
+        cut = 0
+        for match in HTML_TAG_RE.finditer(raw, 0, DESCRIPTION_SCAN):
+            if match.group(1):
+                cut = match.end()
+        if cut:
+            text = html_to_text(raw[:cut])
+            if len(text) >= DESCRIPTION_LIMIT:
+                return text[:DESCRIPTION_LIMIT]
+    return html_to_text(raw)[:DESCRIPTION_LIMIT]
+
+
+# fromisoformat() only accepts a trailing "Z" from Python 3.11
+NEEDS_Z_FIX = sys.version_info < (3, 11)
+
+
+@lru_cache(maxsize=4096)
 def parse_canvas_date(d):
     if not d:
         return None
     try:
-        return datetime.fromisoformat(d.replace("Z", "+00:00"))
+        return datetime.fromisoformat(d.replace("Z", "+00:00") if NEEDS_Z_FIX else d)
     except:
         return None
 
@@ -69,16 +197,31 @@ DUE_START_DT = parse_filter_date(DUE_DATE_PERIOD_START)
 DUE_END_DT = parse_filter_date(DUE_DATE_PERIOD_END)
 
 
-def status_from_canvas(assignment, submission):
+def canvas_assignment_bucket():
+    """Canvas `bucket` covering the due-date filter, so less is downloaded."""
+    now = datetime.now(timezone.utc)
+    # "future" = everything not yet past due, including undated assignments
+    if DUE_START_DT and DUE_START_DT >= now:
+        return "future"
+    # "past" = due before now; never contains undated assignments
+    if DUE_END_DT and DUE_END_DT < now and not INCLUDE_ASSIGNMENTS_WITHOUT_DUE_DATE:
+        return "past"
+    return None
+
+
+ASSIGNMENT_BUCKET = canvas_assignment_bucket()
+
+
+COMPLETED_STATES = frozenset(["graded", "submitted", "pending_review"])
+
+
+def status_from_canvas(assignment, submission, due_dt, now):
     """Reproduce EXACT n8n Transform logic."""
     sub_state = submission.get("workflow_state") if submission else None
-    due_at = assignment.get("due_at")
-    due_dt = parse_canvas_date(due_at)
-    now = datetime.now(timezone.utc)
 
     status = "Not Started"
 
-    if sub_state in ["graded", "submitted", "pending_review"]:
+    if sub_state in COMPLETED_STATES:
         status = "Completed"
     elif assignment.get("has_submitted_submissions"):
         status = "Completed"
@@ -96,6 +239,15 @@ def status_from_canvas(assignment, submission):
 # ==============================
 # CANVAS LOGIC
 # ==============================
+def canvas_paginate(url):
+    """Yield items from a Canvas list endpoint, following Link: rel="next" pages."""
+    while url:
+        r = CANVAS_SESSION.get(url, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        yield from r.json()
+        url = r.links.get("next", {}).get("url")
+
+
 def get_canvas_courses():
     url = (
         f"{CANVAS_BASE_URL}/api/v1/courses"
@@ -104,14 +256,10 @@ def get_canvas_courses():
         "&state[]=available"
         "&per_page=100"
     )
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    courses = r.json()
+    courses = canvas_paginate(url)
 
     if CANVAS_COURSE_IDS:
-        courses = [c for c in courses if str(c["id"]) in CANVAS_COURSE_IDS]
+        courses = (c for c in courses if str(c["id"]) in CANVAS_COURSE_IDS)
 
     course_map = {}
     for c in courses:
@@ -124,25 +272,22 @@ def get_canvas_courses():
     return course_map
 
 
-def get_assignments(course_id):
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-    url = f"{CANVAS_BASE_URL}/api/v1/courses/{course_id}/assignments?per_page=100"
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    return r.json()
-
-
-def get_submission(course_id, assignment_id):
-    url = f"{CANVAS_BASE_URL}/api/v1/courses/{course_id}/assignments/{assignment_id}/submissions/self"
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        return {}
-    return r.json()
+def iter_assignments(course_id):
+    # include[]=submission returns the student's own submission inline
+    url = (
+        f"{CANVAS_BASE_URL}/api/v1/courses/{course_id}/assignments"
+        "?per_page=100&include[]=submission"
+    )
+    if ASSIGNMENT_BUCKET:
+        url += f"&bucket={ASSIGNMENT_BUCKET}"
+    for a in canvas_paginate(url):
+        # Parsed once here, reused by the filter, status and page builder
+        a["_due_dt"] = parse_canvas_date(a.get("due_at"))
+        yield a
 
 
 def due_date_filter_ok(assignment):
-    due = parse_canvas_date(assignment.get("due_at"))
+    due = assignment["_due_dt"]
 
     if due is None:
         return INCLUDE_ASSIGNMENTS_WITHOUT_DUE_DATE
@@ -159,97 +304,193 @@ def due_date_filter_ok(assignment):
     return True
 
 
+def get_filtered_assignments(course_id):
+    """Assignments for one course that pass the due-date filter."""
+    kept = []
+    for a in iter_assignments(course_id):
+        if due_date_filter_ok(a):
+            # Swap the raw HTML for the short cleaned text so it can be freed now
+            a["description"] = clean_description(a.get("description"))
+            kept.append(a)
+    return kept
+
+
 # ==============================
 # NOTION LOGIC
 # ==============================
-def archive_old_db():
-    """Archive old DB titled exactly the same."""
-    url = f"https://api.notion.com/v1/blocks/{NOTION_PARENT_PAGE_ID}/children?page_size=50"
-    r = requests.get(url, headers=get_headers())
-    r.raise_for_status()
+# EXACT LEGACY SCHEMA (Version A)
+LEGACY_SCHEMA = {
+    "Name": {"title": {}},
+    "Assignment Updated Date": {"date": {}},
+    "Class": {"rich_text": {}},
+    "Description": {"rich_text": {}},
+    "Due Date": {"date": {}},
+    "ID": {"rich_text": {}},
+    "Link": {"url": {}},
+    "Points": {"number": {}},
+    "Score": {"number": {}},
+    "Status": {
+        "select": {
+            "options": [
+                {"name": "Overdue", "color": "yellow"},
+                {"name": "In Progress", "color": "orange"},
+                {"name": "Completed", "color": "green"},
+                {"name": "Not Started", "color": "blue"},
+            ]
+        }
+    },
+    "Submitted Date": {"date": {}},
+}
 
-    for block in r.json().get("results", []):
-        if block["type"] == "child_database":
-            title = block["child_database"].get("title")
-            if title == NOTION_DB_TITLE:
-                db_id = block["id"]
-                print(f"Archiving old DB: {db_id}")
-                patch = {
-                    "archived": True
-                }
-                r2 = requests.patch(
-                    f"https://api.notion.com/v1/databases/{db_id}",
-                    headers=get_headers(),
-                    json=patch,
-                )
-                r2.raise_for_status()
+# Shared property values, reused across pages instead of rebuilt per row
+STATUS_SELECT = {
+    s: {"select": {"name": s}}
+    for s in ("Overdue", "In Progress", "Completed", "Not Started")
+}
 
 
-def create_db():
-    schema = {
-        # EXACT LEGACY SCHEMA (Version A)
-        "Name": {"title": {}},
-        "Assignment Updated Date": {"date": {}},
-        "Class": {"rich_text": {}},
-        "Description": {"rich_text": {}},
-        "Due Date": {"date": {}},
-        "ID": {"rich_text": {}},
-        "Link": {"url": {}},
-        "Points": {"number": {}},
-        "Score": {"number": {}},
-        "Status": {
-            "select": {
-                "options": [
-                    {"name": "Overdue", "color": "yellow"},
-                    {"name": "In Progress", "color": "orange"},
-                    {"name": "Completed", "color": "green"},
-                    {"name": "Not Started", "color": "blue"},
-                ]
-            }
-        },
-        "Submitted Date": {"date": {}},
-    }
+def class_property(course):
+    return {"rich_text": [{"text": {"content": clip_text(course["short_name"] or "")}}]}
+
+
+def find_existing_dbs():
+    """IDs of child databases under the parent page titled exactly the same."""
+    path = f"/blocks/{NOTION_PARENT_PAGE_ID}/children?page_size=100"
+    cursor = None
+    db_ids = []
+    while True:
+        data = notion_request("GET", path + (f"&start_cursor={cursor}" if cursor else ""))
+        for block in data.get("results", []):
+            if block["type"] == "child_database":
+                title = block["child_database"].get("title")
+                if title == NOTION_DB_TITLE:
+                    db_ids.append(block["id"])
+        if not data.get("has_more"):
+            return db_ids
+        cursor = data["next_cursor"]
+
+
+def schema_matches(db_id):
+    """True if the DB has exactly the legacy property names and types."""
+    db = notion_request("GET", f"/databases/{db_id}")
+    current = {name: prop["type"] for name, prop in db["properties"].items()}
+    expected = {name: next(iter(prop)) for name, prop in LEGACY_SCHEMA.items()}
+    return current == expected
 
+
+def archive_db(db_id):
+    print(f"Archiving old DB: {db_id}")
+    notion_request("PATCH", f"/databases/{db_id}", {"archived": True})
+
+
+def create_db():
     body = {
         "parent": {"type": "page_id", "page_id": NOTION_PARENT_PAGE_ID},
         "title": [{"type": "text", "text": {"content": NOTION_DB_TITLE}}],
-        "properties": schema,
+        "properties": LEGACY_SCHEMA,
     }
 
-    url = "https://api.notion.com/v1/databases"
-    r = requests.post(url, headers=get_headers(), json=body)
-    r.raise_for_status()
-    return r.json()["id"]
+    return notion_request("POST", "/databases", body, NOTION_CREATE_SESSION)["id"]
 
 
-def create_page(db_id, course, a, submission):
+def get_or_create_db():
+    """Reuse the existing DB while its schema is unchanged, else recreate it."""
+    reuse_id = None
+    for db_id in find_existing_dbs():
+        if reuse_id is None and schema_matches(db_id):
+            reuse_id = db_id
+        else:
+            archive_db(db_id)
+
+    if reuse_id:
+        print(f"Reusing DB {reuse_id}")
+        return reuse_id
+
+    db_id = create_db()
+    print(f"Created DB {db_id}")
+    return db_id
+
+
+def query_db_pages(db_id):
+    """Yield every page in the DB, following Notion's cursor pagination."""
+    body = {"page_size": 100}
+    while True:
+        data = notion_request("POST", f"/databases/{db_id}/query", body)
+        yield from data.get("results", [])
+        if not data.get("has_more"):
+            return
+        body["start_cursor"] = data["next_cursor"]
+
+
+def property_value(prop):
+    """Comparable value of a property, as sent to or returned by Notion."""
+    kind = prop.get("type") or next(iter(prop))
+    value = prop[kind]
+    if kind in ("title", "rich_text"):
+        # Mentions and equations typed in Notion have no "text" key
+        return "".join(
+            t["plain_text"] if "plain_text" in t else t["text"]["content"]
+            for t in value or []
+        )
+    if kind == "date":
+        # Notion keeps date-times to the minute; Canvas sends seconds
+        start = parse_canvas_date(value["start"]) if value else None
+        return start.replace(second=0, microsecond=0) if start else None
+    if kind == "select":
+        return value["name"] if value else None
+    return value
+
+
+def page_canvas_id(page):
+    return property_value(page["properties"]["ID"]) if "ID" in page["properties"] else ""
+
+
+def page_is_current(page, properties):
+    """True if the existing row already holds every value we would write."""
+    existing = page["properties"]
+    return all(
+        name in existing and property_value(existing[name]) == property_value(prop)
+        for name, prop in properties.items()
+    )
+
+
+def build_properties(class_prop, a, submission, now):
     updated = parse_canvas_date(a.get("updated_at"))
-    due = parse_canvas_date(a.get("due_at"))
+    due = a["_due_dt"]
     submitted = parse_canvas_date(submission.get("submitted_at") if submission else None)
 
-    description_clean = clean_description(a.get("description", ""))
-
-    status = status_from_canvas(a, submission)
+    status = status_from_canvas(a, submission, due, now)
 
-    body = {
-        "parent": {"database_id": db_id},
-        "properties": {
-            "Name": {"title": [{"text": {"content": a.get("name", "")}}]},
-            "Assignment Updated Date": {"date": {"start": updated.isoformat()} if updated else None},
-            "Class": {"rich_text": [{"text": {"content": course["short_name"]}}]},
-            "Description": {"rich_text": [{"text": {"content": description_clean}}]},
-            "Due Date": {"date": {"start": due.isoformat()} if due else None},
-            "ID": {"rich_text": [{"text": {"content": str(a.get("id"))}}]},
-            "Link": {"url": a.get("html_url")},
-            "Points": {"number": a.get("points_possible")},
-            "Score": {"number": submission.get("score") if submission else None},
-            "Status": {"select": {"name": status}},
-            "Submitted Date": {"date": {"start": submitted.isoformat()} if submitted else None},
-        },
+    return {
+        "Name": {"title": [{"text": {"content": clip_text(a.get("name") or "")}}]},
+        "Assignment Updated Date": {"date": {"start": updated.isoformat()} if updated else None},
+        "Class": class_prop,
+        "Description": {"rich_text": [{"text": {"content": a["description"]}}]},
+        "Due Date": {"date": {"start": due.isoformat()} if due else None},
+        "ID": {"rich_text": [{"text": {"content": str(a.get("id"))}}]},
+        "Link": {"url": a.get("html_url")},
+        "Points": {"number": a.get("points_possible")},
+        "Score": {"number": submission.get("score") if submission else None},
+        "Status": STATUS_SELECT[status],
+        "Submitted Date": {"date": {"start": submitted.isoformat()} if submitted else None},
     }
 
-    r = requests.post("https://api.notion.com/v1/pages", headers=get_headers(), json=body)
-    r.raise_for_status()
+
+def write_page(db_id, page_id, properties):
+    """Update the existing row in place, or create it if it is new."""
+    if page_id:
+        notion_request("PATCH", f"/pages/{page_id}", {"properties": properties})
+    else:
+        notion_request(
+            "POST",
+            "/pages",
+            {"parent": {"database_id": db_id}, "properties": properties},
+            NOTION_CREATE_SESSION,
+        )
+
+
+def archive_page(page_id):
+    notion_request("PATCH", f"/pages/{page_id}", {"archived": True})
 
 
 # ==============================
@@ -265,25 +506,52 @@ def main():
         print("No courses found.")
         return
 
-    # 2) Archive old DB
-    archive_old_db()
+    # 2) Reuse the DB if its schema is unchanged, otherwise archive + recreate
+    db_id = get_or_create_db()
 
-    # 3) Create new DB
-    db_id = create_db()
-    print(f"Created DB {db_id}")
+    # 3) Fetch and filter assignments (with submissions) for all courses concurrently
+    with ThreadPoolExecutor(max_workers=CANVAS_MAX_WORKERS) as pool:
+        assignments_by_course = dict(
+            zip(course_map, pool.map(get_filtered_assignments, course_map))
+        )
 
-    # 4) Process assignments
+    # 4) Build page properties keyed by Canvas ID
+    now = datetime.now(timezone.utc)
+    rows = {}
     for cid, info in course_map.items():
-        assignments = get_assignments(cid)
-
-        for a in assignments:
-            if not due_date_filter_ok(a):
-                continue
-
-            submission = get_submission(cid, a["id"])
-            create_page(db_id, info, a, submission)
-
-    print("Sync complete.")
+        class_prop = class_property(info)
+        for a in assignments_by_course[cid]:
+            submission = a.get("submission") or {}
+            rows[str(a.get("id"))] = build_properties(class_prop, a, submission, now)
+
+    # 5) Index existing rows once; anything not in this sync (or a duplicate) is stale
+    page_index = {}
+    stale_page_ids = []
+    for page in query_db_pages(db_id):
+        canvas_id = page_canvas_id(page)
+        if canvas_id in rows and canvas_id not in page_index:
+            page_index[canvas_id] = page
+        else:
+            stale_page_ids.append(page["id"])
+
+    # 6) Only write rows that are new or whose values changed
+    writes = []
+    for canvas_id, properties in rows.items():
+        page = page_index.get(canvas_id)
+        if page is None:
+            writes.append((None, properties))
+        elif not page_is_current(page, properties):
+            writes.append((page["id"], properties))
+
+    # 7) Update / create / archive pages through a small worker pool
+    with ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS) as pool:
+        list(pool.map(lambda w: write_page(db_id, *w), writes))
+        list(pool.map(archive_page, stale_page_ids))
+
+    print(
+        f"Sync complete: {len(writes)} written, "
+        f"{len(rows) - len(writes)} unchanged, {len(stale_page_ids)} archived."
+    )
 
 
 if __name__ == "__main__":